@@ -1,4 +1,18 @@
-from machine import Pin, Timer
+import micropython
+from array import array
+from machine import Pin, Timer, disable_irq, enable_irq
+from time import ticks_us, ticks_diff, ticks_add
+
+try:
+    _popcount = int.bit_count    # native popcount on CPython 3.10+ and builds that expose it
+except AttributeError:
+    _popcount = None
+    _PARITY_LUT = bytes(bin(i).count('1') & 1 for i in range(256))    # parity of every byte value
+
+_RING_SIZE = 8    # number of completed reads kept by a Wiegand reader, must be a power of 2
+_RING_MASK = _RING_SIZE - 1
+_ONE_SHOT = Timer.ONE_SHOT
+_DEFAULT = object()    # marks an argument that wasn't passed, where None has its own meaning
 
 class Wiegand:
     """
@@ -8,15 +22,19 @@ class Wiegand:
     Wiegand protocol has no specific pulse timing specs.
     Protocol typically sends normally-high 5V input via Data0 (green) and Data1 (white) signal wires.
     Each is pulsed low to signal either a 0 bit (on the Data0 line) or a 1 bit (on the Data1 line).
-    This reader triggers on falling edges and assumes the read is done if at least 250ms has elapsed since last bit received.
-    The implementation reads any number of bits.
-    You can discard bad reads with unexpected bit counts on the receiving end if you like, or adjust the code to discard them on this side (see comment in code).
+    This reader triggers on falling edges using interrupt handlers compiled with viper (hard interrupts where the port supports them), and assumes the read is done if at least 250ms has elapsed since last bit received.
+    The implementation reads up to 64 bits (longer reads are discarded), and by default also discards reads whose bit count is not in VALID_BIT_COUNTS
+    (line noise, reader resets, etc) before a Card is created. Pass valid_bit_counts=None to receive every read.
 
     Use the Card.parse() method to optionally parse the returned card into parts (facility, card number, etc),
         and to apply parity checking. Several common formats are implemented, but you can add your own.
     """
 
-    def __init__(self, pin0: int, pin1: int, callback = None, timer_id: int = -1):
+    # bit counts of the common Wiegand card formats (26 bit H10301, 34 bit, 35 bit Corporate 1000, 36 bit, 37 bit H10304)
+    VALID_BIT_COUNTS = frozenset({26, 34, 35, 36, 37})
+
+    def __init__(self, pin0: int, pin1: int, callback = None, timer_id: int = -1, valid_bit_counts = _DEFAULT, debounce_us: int = 0,
+                 expected_bits: int = None):
         """
         Inits a new Wiegand object to read from the specified pins.
 
@@ -25,75 +43,251 @@ class Wiegand:
             pin1 - the pin number that toggles when a one is sent by the reader (data1, white wire)
             callback - the optional function to call when a card is successfully read.
                    eg. def mycallback(card)
-                   Leave None if you do not want a callback and will poll using get_card() instead.
+                   Leave None if you do not want a callback and will poll using get_card() or get_card_raw() instead.
             timer_id - the Timer ID number to use for completion checks. Defaults to -1
+            valid_bit_counts - the bit counts of reads to report. Reads with any other bit count are discarded.
+                   Defaults to the class's VALID_BIT_COUNTS, which a subclass can override. Use None to report reads of any length up to 64 bits.
+            debounce_us - ignore falling edges that arrive less than this many microseconds after the previous one,
+                   so a noisy line doesn't add extra bits. Wiegand bits are normally ~2ms apart, so eg 40 is safe.
+                   Defaults to 0 (disabled).
+            expected_bits - the card format (a Card._FORMATS code, eg 26 or 36) read by this reader, if it only ever reads one.
+                   A parser specialized for that format is generated, and each card is parsed with it before it is handed over.
+                   Defaults to None, which leaves cards unparsed so Card.parse() can infer the format.
         """
         self.pin0 = Pin(pin0, Pin.IN, Pin.PULL_UP)
         self.pin1 = Pin(pin1, Pin.IN, Pin.PULL_UP)
         self.callback = callback
-        self.last_card = None
+        self.valid_bit_counts = self.VALID_BIT_COUNTS if valid_bit_counts is _DEFAULT else valid_bit_counts
+        self._parse_fn = _make_parser(expected_bits) if expected_bits else None
+        self._last_card = None    # Card for the latest read, only built when the callback, get_card() or last_card needs it
+        self._last_card_count = 0    # card_count that _last_card was built for
         self.card_count = 0
-        self.doneCheckBits = 0    # stores bit count at last timer interrupt to check if bit count changed since last check
-        self.next_card = 0   # accumulates the current card number being red
-        self.bits = 0    # counts the bits of the current card being read
+        # state shared with the hard interrupt handlers, which can't allocate or use Python ints above 32 bits:
+        #   [0] low 32 bits of the current card number being read
+        #   [1] high 32 bits of the current card number being read
+        #   [2] counts the bits of the current card being read
+        #   [3] indicates if a restart of the 'done' timer is waiting in the scheduler
+        #   [4] ticks_us() of the last accepted edge
+        #   [5] debounce window in microseconds, 0 if disabled
+        # seeded one window in the past, so the very first edge is accepted
+        self._buf = array('L', [0, 0, 0, 0, ticks_add(ticks_us(), -debounce_us), debounce_us])
+        self._pending = array('L', [0, 0])    # low and high word of the read being recorded by _doneCheck()
+        # ring of the most recent completed reads, one array per field so recording a read allocates nothing.
+        # Read number n (counting from 1, as card_count does) is stored in slot (n - 1) & _RING_MASK.
+        self._ring_lo = array('L', [0] * _RING_SIZE)    # low 32 bits of the card number
+        self._ring_hi = array('L', [0] * _RING_SIZE)    # high 32 bits of the card number
+        self._ring_bits = array('H', [0] * _RING_SIZE)    # bit count
+        self._dispatched = 0    # card_count of the last read handed to the callback
+        self._finalize_pending = False    # indicates if _finalize() is waiting in the scheduler
         self.timer = Timer(timer_id)    # only create the timer once and reuse it as needed
-        self.timerSet = False    # indicates if timer is currently in use
-        self.pin0.irq(trigger=Pin.IRQ_FALLING, handler=self._on_pin0)
-        self.pin1.irq(trigger=Pin.IRQ_FALLING, handler=self._on_pin1)
+        self._rearm_ref = self._rearm    # bound method allocated once, hard interrupts can't allocate it
+        self._finalize_ref = self._finalize
+        self._doneCheck_ref = self._doneCheck
+        # hard interrupts run the handlers straight from the edge instead of via the scheduler.
+        # Ports whose Pin.irq() accepts hard=True (eg ESP32, RP2040, STM32) get them, others fall back to soft interrupts.
+        try:
+            self.pin0.irq(trigger=Pin.IRQ_FALLING, handler=self._on_pin0, hard=True)
+            self.pin1.irq(trigger=Pin.IRQ_FALLING, handler=self._on_pin1, hard=True)
+            self.hard_irq = True
+        except TypeError:
+            self.pin0.irq(trigger=Pin.IRQ_FALLING, handler=self._on_pin0)
+            self.pin1.irq(trigger=Pin.IRQ_FALLING, handler=self._on_pin1)
+            self.hard_irq = False
 
     def get_card(self):
         """
         Return a tuple containing the last successfully read card and read number.
         Use the read number to determine if a new card read event has occurred since the last time you polled for a card.
+        The Card object is only created the first time it is asked for - use get_card_raw() to poll without allocating.
+        """
+        count = self.card_count
+        if count != self._last_card_count:
+            self._last_card = self._card((count - 1) & _RING_MASK)
+            self._last_card_count = count
+        return (self._last_card, count)
+
+    @property
+    def last_card(self):
+        """
+        The last successfully read card, or None if no card has been read yet.
+        Like get_card(), the Card object is only created the first time it is asked for.
+        """
+        return self.get_card()[0]
+
+    def get_card_raw(self):
+        """
+        Return a tuple containing the raw number and bit count of the last successfully read card, and the read number.
+        Returns (0, 0, 0) if no card has been read yet.
+        Use the read number to determine if a new card read event has occurred since the last time you polled for a card.
         """
-        return (self.last_card, self.card_count)
+        count = self.card_count
+        i = (count - 1) & _RING_MASK
+        return ((self._ring_hi[i] << 32) | self._ring_lo[i], self._ring_bits[i], count)
 
+    def _card(self, i):
+        """
+        Build the Card for the read in ring slot i.
+        Parse it with the expected format's parser if the reader was given one.
+        """
+        card = Card((self._ring_hi[i] << 32) | self._ring_lo[i], self._ring_bits[i])
+        if self._parse_fn:
+            self._parse_fn(card)
+        return card
+
+    @micropython.viper
     def _on_pin0(self, newstate):
-        """ Interrupt handler for data0 signal """
-        self._on_pin(0)
+        """
+        Interrupt handler for data0 signal, safe to run as a hard interrupt.
+        Ignore the edge if it falls within the debounce window of the previous one.
+        Shift a 0 bit into the current card number, carrying into the high word.
+        Schedule a restart of the "done" timer.
+        """
+        buf = ptr32(self._buf)
+        if buf[5] != 0:
+            now = int(ticks_us())
+            # ticks wrap, so an edge long after the last one can give a negative difference - only drop real bounces
+            d = int(ticks_diff(now, buf[4]))
+            if d >= 0 and d < buf[5]:
+                return
+            buf[4] = now
+        lo = buf[0]
+        buf[1] = (buf[1] << 1) | ((lo >> 31) & 1)
+        buf[0] = lo << 1
+        buf[2] = buf[2] + 1
+        if buf[3] == 0:
+            # timers can't be set up from a hard interrupt - let the scheduler restart it.
+            # Only flag the restart as pending once it is queued, so a full scheduler queue is retried on the next bit.
+            try:
+                micropython.schedule(self._rearm_ref, 0)
+                buf[3] = 1
+            except RuntimeError:
+                pass
 
+    @micropython.viper
     def _on_pin1(self, newstate):
-        """ Interrupt handler for data1 signal """
-        self._on_pin(1)
+        """
+        Interrupt handler for data1 signal, safe to run as a hard interrupt.
+        Ignore the edge if it falls within the debounce window of the previous one.
+        Shift a 1 bit into the current card number, carrying into the high word.
+        Schedule a restart of the "done" timer.
+        """
+        buf = ptr32(self._buf)
+        if buf[5] != 0:
+            now = int(ticks_us())
+            # ticks wrap, so an edge long after the last one can give a negative difference - only drop real bounces
+            d = int(ticks_diff(now, buf[4]))
+            if d >= 0 and d < buf[5]:
+                return
+            buf[4] = now
+        lo = buf[0]
+        buf[1] = (buf[1] << 1) | ((lo >> 31) & 1)
+        buf[0] = (lo << 1) | 1
+        buf[2] = buf[2] + 1
+        if buf[3] == 0:
+            # timers can't be set up from a hard interrupt - let the scheduler restart it.
+            # Only flag the restart as pending once it is queued, so a full scheduler queue is retried on the next bit.
+            try:
+                micropython.schedule(self._rearm_ref, 0)
+                buf[3] = 1
+            except RuntimeError:
+                pass
 
-    def _on_pin(self, bitvalue: 0|1):
+    def _rearm(self, _):
         """
-        Common interrupt handling code for data0 or data1 signal.
-        Accumulate the bit into the current card number.
-        Start the "done" timer if this is the first bit of a new read.
+        Scheduled by the interrupt handlers when bits arrive.
+        (Re)start the one-shot "done" timer, so it only expires once 250ms have passed without a new bit.
         """
-        self.next_card <<= 1
-        self.next_card += bitvalue
-        self.bits += 1
-        if not self.timerSet:
-            # start the 'done' timer
-            self.doneCheckBits = self.bits
-            self.timer.init(period=250, mode=Timer.PERIODIC, callback=self._doneCheck)
-            self.timerSet = True
+        self._buf[3] = 0
+        self.timer.init(period=250, mode=_ONE_SHOT, callback=self._doneCheck_ref)
 
+    @micropython.native
     def _doneCheck(self, t):
         """
         Timer callback handler.
-        When the 'done' check timer expires, determine if any bits have arrived during the previous period.
-        If yes, update the done check bit counter to the current value and let timer continue.
-        If no, stop the timer, record the completed card, and call the callback if required.
-        """
-        if self.bits == self.doneCheckBits:
-            # no additional bits detected in last timer period - read must be done
-            self.timer.deinit()
-            self.timerSet = False
-            # can add validation here if you want to suppress/discard unrecognized data (eg bad bit counts, etc)
-            self.last_card = Card(self.next_card, self.bits)
-            self.card_count += 1
-            self.doneCheckBits = 0
-            self.next_card = 0
-            self.bits = 0
+        The one-shot 'done' timer is restarted on every bit, so when it expires no bits have arrived
+        for a whole period and the read is done.
+        Record the completed read in the ring, and leave building Cards and calling the callback
+        to _finalize() through the scheduler, so no allocation or user code runs in the timer interrupt.
+        """
+        bits = self._take()
+        if not bits:
+            # the bits were already collected by an earlier expiry that raced with a pending restart
+            return
+        if bits > 64:
+            # the accumulator only holds 64 bits - the start of this read has been shifted out, so don't report it
+            return
+        valid = self.valid_bit_counts
+        if valid is not None and bits not in valid:
+            # not a card format we expect - most likely noise on the data lines, drop it before anything is allocated
+            return
+        count = self.card_count
+        i = count & _RING_MASK
+        self._store(i)
+        self._ring_bits[i] = bits
+        self.card_count = count + 1
+        if not self.callback:
+            # polling only - nothing to hand over
+            self._dispatched = count + 1
+        elif not self._finalize_pending:
+            # one scheduled _finalize() hands over every read that completes before it runs.
+            # If the queue is full, clear the flag again so the next read retries.
+            self._finalize_pending = True
+            try:
+                micropython.schedule(self._finalize_ref, 0)
+            except RuntimeError:
+                self._finalize_pending = False
+
+    @micropython.viper
+    def _take(self) -> int:
+        """
+        Move the card number words of the current read into _pending, reset the accumulator, and return the bit count.
+        Used by _doneCheck(). Viper copies the words as machine words - reading them as Python ints would allocate above 30 bits.
+        """
+        buf = ptr32(self._buf)
+        pending = ptr32(self._pending)
+        # keep the interrupt handlers out while the card state is read and reset
+        state = disable_irq()
+        bits = buf[2]
+        pending[0] = buf[0]
+        pending[1] = buf[1]
+        buf[0] = 0
+        buf[1] = 0
+        buf[2] = 0
+        enable_irq(state)
+        return bits
+
+    @micropython.viper
+    def _store(self, i: int):
+        """
+        Copy the card number words in _pending into ring slot i, without creating Python ints.
+        Used by _doneCheck()
+        """
+        pending = ptr32(self._pending)
+        ring_lo = ptr32(self._ring_lo)
+        ring_hi = ptr32(self._ring_hi)
+        ring_lo[i] = pending[0]
+        ring_hi[i] = pending[1]
+
+    def _finalize(self, _):
+        """
+        Scheduled by _doneCheck() when a read is complete.
+        Build the Card and call the callback for every read recorded since the last call,
+        so reads that complete while the scheduler is held up (GC, Wi-Fi, etc) are not lost.
+        """
+        self._finalize_pending = False
+        count = self.card_count
+        n = self._dispatched
+        if count - n > _RING_SIZE:
+            # more reads completed than the ring holds before we got to run - the oldest were overwritten
+            n = count - _RING_SIZE
+        while n != count:
+            card = self._card(n & _RING_MASK)
+            n += 1
+            self._dispatched = n
+            self._last_card = card
+            self._last_card_count = n
             if self.callback:
-                self.callback(self.last_card)
-        else:
-            # more bits were received within the last period.
-            # Remember new bit count to check for change in the next period
-            self.doneCheckBits = self.bits
+                self.callback(card)
 
 class Card:
     """
@@ -111,9 +305,33 @@ class Card:
     Methods:
         parse(): applies a card format to the raw card data. If successful, it will set "valid". "facility", "number", and "format".
             Parse will assume a format based on the bit count, but you can force a different format explicitly.
-            Can extend the logic with your own formats inside this method.
+            Can extend it with your own formats by adding entries to _FORMATS.
     """
 
+    __slots__ = ('raw_number', 'bits', 'facility', 'number', 'format', 'valid', '_str_cache')
+
+    # Card formats understood by parse(), keyed by format code:
+    #   (bits, hi_shift, lo_mask, fac_shift, fac_mask, num_shift, num_mask, hi_parity, lo_parity)
+    # The card must have been read with exactly `bits` bits.
+    # raw >> hi_shift must have parity hi_parity and raw & lo_mask must have parity lo_parity (0 = EVEN, 1 = ODD).
+    # The facility code is (raw >> fac_shift) & fac_mask and the card number is (raw >> num_shift) & num_mask.
+    _FORMATS = {
+        # Proximity card H10301 (26 bit) format
+        # [high] PFFFFFFFFNNNNNNNNNNNNNNNNP [low]
+        # (1 Parity + 8 facility + 16 Card Number + 1 Parity)
+        # First 13 (high) bits are EVEN parity
+        # Last 13 (low) bit are ODD parity
+        # Facility code (F) is 8 bits: 0 - 255
+        # Card number (N) is 16 bits: 0 - 65535
+        26: (26, 13, 0x1FFF, 17, 0xFF, 1, 0xFFFF, 0, 1),
+        # Proximity card (36 bit) format
+        # [high] PFFFFFFFFFFFFFFNNNNNNNNNNNNNNNNNNNNP [low]
+        # (1 Parity + 14 facility + 20 Card Number + 1 Parity)
+        # First 18 (high) bits are EVEN parity
+        # Last 18 (low) bit are ODD parity
+        36: (36, 18, 0x3FFFF, 21, 0x3FFF, 1, 0xFFFFF, 0, 1),
+    }
+
     def __init__(self, raw_number: int, bits: int):
         """
         Inits a new Card object with the raw card number and bit count.
@@ -128,16 +346,20 @@ class Card:
         self.number = None
         self.format = None
         self.valid = False
+        self._str_cache = None    # formatted __str__ result, cleared whenever parse() changes the fields
 
     def __str__(self):
-        if self.valid:
-            return  f"{self.facility}-{self.number}"
-        else:
-             return f"{self.raw_number}"
+        if self._str_cache is None:
+            if self.valid:
+                self._str_cache = f"{self.facility}-{self.number}"
+            else:
+                self._str_cache = f"{self.raw_number}"
+        return self._str_cache
         
     def __repr__(self):
          return f"{type(self).__name__}({self.raw_number},{self.bits})"
         
+    @micropython.native
     def parse(self, format = None):
         """
         Return a bool indicating whether the current card successfully parsed into the specified format.
@@ -147,7 +369,7 @@ class Card:
         Implemented formats:
            26: Proximity card H10301 26 bit format with parity checks
            36: Proximity card 36 bit format with parity checks
-        Format code numbers have no intrinsic meaning - you can add additional format code numbers to parse additional values as you need them.
+        Format code numbers have no intrinsic meaning - you can add additional format codes to _FORMATS to parse additional values as you need them.
         """
         if not format and self.valid:
             # no explicit format was requested and card was already successfully parsed - just keep existing parse
@@ -159,44 +381,81 @@ class Card:
             # no format was specified - infer it
             format = self.bits
         # reset parse values in preparation for a new parse
+        self._str_cache = None
         self.valid = False
         self.format = None
         self.number = None
         self.facility = None
-        if format == 26:
-            # Proximity card H10301 (26 bit) format
-            # [high] PFFFFFFFFNNNNNNNNNNNNNNNNP [low]
-            # (1 Parity + 8 facility + 16 Card Number + 1 Parity)
-            # First 13 (high) bits are EVEN parity
-            # Last 13 (low) bit are ODD parity
-            # Facility code (F) is 8 bits: 0 - 255
-            # Card number (N) is 16 bits: 0 - 65535
-            # -- check parity of higher 13 - should be EVEN
-            # -- check parity of lower 13 - should be ODD
-            if self.bits == 26 and self._parity(self.raw_number >> 13) == 0 and self._parity(self.raw_number & 0x1FFF) == 1:
-                # parse was successful
-                self.valid = True
-                self.format = format
-                self.facility = (self.raw_number >> 17) & 0xFF
-                self.number = (self.raw_number >> 1) & 0xFFFF
-        elif format == 36:
-            # Proximity card (36 bit) format
-            # [high] PFFFFFFFFFFFFFFNNNNNNNNNNNNNNNNNNNNP [low]
-            # (1 Parity + 14 facility + 20 Card Number + 1 Parity)
-            # First 18 (high) bits are EVEN parity
-            # Last 18 (low) bit are ODD parity
-            # -- check parity of higher 18 - should be EVEN
-            # -- check parity of lower 18 - should be ODD
-            if self.bits == 36 and self._parity(self.raw_number >> 18) == 0 and self._parity(self.raw_number & 0x3FFFF) == 1:
-                self.valid = True
-                self.format = format
-                self.facility = (self.raw_number >> 21) & 0x3FFF
-                self.number = (self.raw_number >> 1) & 0xFFFFF
+        params = self._FORMATS.get(format)
+        if not params:
+            return False
+        bits, hi_shift, lo_mask, fac_shift, fac_mask, num_shift, num_mask, hi_parity, lo_parity = params
+        raw = self.raw_number
+        if self.bits == bits and self._parity(raw >> hi_shift) == hi_parity and self._parity(raw & lo_mask) == lo_parity:
+            # parse was successful
+            self.valid = True
+            self.format = format
+            self.facility = (raw >> fac_shift) & fac_mask
+            self.number = (raw >> num_shift) & num_mask
         return self.valid
 
+    @micropython.native
     def _parity(self, x):
         """
         Returns 0 for even bit parity and 1 for odd bit parity of value x
         Used by parse()
+        Uses int.bit_count() where available, otherwise combines the parity of each byte from a lookup table.
         """
-        return bin(x).count('1') % 2
+        if _popcount:
+            return _popcount(x) & 1
+        p = 0
+        while x:
+            p ^= _PARITY_LUT[x & 0xFF]
+            x >>= 8
+        return p
+
+def _fold(name, width):
+    """
+    Returns source lines that fold the value in variable `name`, at most `width` bits wide,
+    down to its parity in bit 0. Used by _make_parser()
+    The fold is straight-line code sized to the width: one shift-XOR for each power of 2 below it, largest first.
+    """
+    shift = 1
+    while shift * 2 < width:
+        shift *= 2
+    lines = []
+    while shift and shift < width:
+        lines.append(f"    {name} ^= {name} >> {shift}")
+        shift >>= 1
+    return lines
+
+def _make_parser(format):
+    """
+    Returns a parser for the Card._FORMATS entry `format`, with its shifts, masks and parity folds inlined as constants.
+    The parser takes a Card with reset parse values, as a new Card has, and behaves like card.parse(format).
+    The parser is generated with exec() from the entry as it is now - later changes to _FORMATS don't affect it.
+    """
+    bits, hi_shift, lo_mask, fac_shift, fac_mask, num_shift, num_mask, hi_parity, lo_parity = Card._FORMATS[format]
+    src = [
+        "@micropython.native",
+        "def parse(card):",
+        f"    if card.bits != {bits}:",
+        "        return False",
+        "    raw = card.raw_number",
+        f"    lo = raw & {lo_mask}",
+    ]
+    src += _fold("lo", len(bin(lo_mask)) - 2)
+    src.append(f"    hi = raw >> {hi_shift}")
+    src += _fold("hi", bits - hi_shift)
+    src += [
+        f"    if {'' if lo_parity else 'not '}lo & 1 and {'' if hi_parity else 'not '}hi & 1:",
+        "        card._str_cache = None",
+        "        card.valid = True",
+        f"        card.format = {format}",
+        f"        card.facility = (raw >> {fac_shift}) & {fac_mask}",
+        f"        card.number = (raw >> {num_shift}) & {num_mask}",
+        "    return card.valid",
+    ]
+    namespace = {'micropython': micropython}
+    exec("\n".join(src), namespace)
+    return namespace['parse']